@@ -1,14 +1,61 @@
 import streamlit as st
 from google.cloud import firestore_v1
+from google.cloud.firestore_v1.watch import ChangeType
+import pandas as pd
 import os
 import json
 import threading
 import queue
-import time
+import itertools
+import string
+import atexit
+import logging
+import uuid
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
 
 GOOGLE_CLOUD_PROJECT_ID = "infiniquant-da402"
 FIRESTORE_APP_ID = "1:608512799755:web:def0b365b005ef6166c30e"
 FIRESTORE_COLLECTION_NAME = "quant_strategies"
+FIRESTORE_COLLECTION_PATH = f"artifacts/infiniquant-da402/public/data/{FIRESTORE_COLLECTION_NAME}"
+
+logger = logging.getLogger(__name__)
+DECODE_WORKERS = 4
+UPDATE_QUEUE_SIZE = 8
+# Cached entries are keyed on an ever-increasing snapshot version; keep only the
+# few recent versions sessions may still be on.
+VERSION_CACHE_ENTRIES = 4
+# Roughly one entry per displayed strategy; stale metric sets age out.
+METRICS_MD_CACHE_ENTRIES = 1024
+
+BASE_STRATEGIES = ("RSI_ONLY", "MACD_ONLY", "SMA_CROSSOVER", "EMA_CROSSOVER", "BB_BOUNCE",
+                   "RSI_SENTIMENT", "MACD_SENTIMENT", "SMA_SENTIMENT", "ML_PREDICT",
+                   "FF_INSPIRED_STRATEGY")
+QUOTED_BASE = tuple(f'"{s}"' for s in BASE_STRATEGIES)
+
+DISPLAY_DEFAULTS = dict.fromkeys(
+    ("Strategy_Name", "Strategy_Type", "Description", "Risk_Level", "Recommended_Capital", "Last_Updated", "id"),
+    "N/A",
+)
+EXPANDER_TEMPLATE = string.Template("**$Strategy_Name** - Type: $Strategy_Type")
+DETAILS_TEMPLATE = string.Template("\n\n".join((
+    "**Description:** $Description",
+    "**Performance Metrics:**",
+    "$metrics_md",
+    "**Risk Level:** $Risk_Level",
+    "**Recommended Capital:** $Recommended_Capital",
+    "**Last Updated:** $Last_Updated",
+)))
+CAPTION_TEMPLATE = string.Template("Document ID: $id")
+
+# Short frame column -> Performance_Metrics field, extracted once per decoded document
+METRIC_COLUMNS = {
+    "sharpe": "Sharpe_Ratio",
+    "pf": "Profit_Factor",
+    "sortino": "Sortino_Ratio",
+    "total_return": "Total_Return",
+}
+ROW_COLUMNS = ("Strategy_Name", "Strategy_Type", *METRIC_COLUMNS)
 
 @st.cache_resource
 def get_firestore_client():
@@ -21,7 +68,6 @@ def get_firestore_client():
             project=st.secrets["gcp_service_account"]["project_id"],
             credentials=credentials
         )
-        st.success("Successfully initialized Firestore client.")
         return db
     except Exception as e:
         st.error(f"Error initializing Firestore: {e}")
@@ -29,140 +75,310 @@ def get_firestore_client():
 
 @st.cache_resource
 def get_update_queue():
-    return queue.Queue()
+    return queue.Queue(maxsize=UPDATE_QUEUE_SIZE)
+
+@st.cache_resource(on_release=lambda pool: pool.shutdown(wait=False, cancel_futures=True))
+def get_decode_executor():
+    return ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="firestore-decode")
+
+# Canonical id -> (document, frame row) state, shared with the listener thread
+# (which has no access to st.session_state) and mutated incrementally from
+# change deltas.
+@st.cache_resource
+def get_strategies_by_id():
+    return {}
+
+@st.cache_resource
+def get_store_lock():
+    return threading.Lock()
+
+# Set by the first snapshot callback so cold starts wait for data, not a clock.
+@st.cache_resource
+def get_ready_event():
+    return threading.Event()
+
+# Versions carry a per-cache generation so that a "Clear cache", which restarts
+# the counter, never reissues a key a session may still hold old rows for.
+@st.cache_resource
+def get_snapshot_versions():
+    return zip(itertools.repeat(uuid.uuid4().hex), itertools.count(1))
+
+# Version of the store contents; sessions compare their copy's version against
+# it on every rerun.
+@st.cache_resource
+def get_latest_update():
+    return {'version': 0}
+
+@st.cache_data(show_spinner=False, max_entries=VERSION_CACHE_ENTRIES)
+def to_frame(snapshot_version, _rows):
+    # Keyed on the snapshot version only; the payload itself is never hashed.
+    df = pd.DataFrame.from_records(list(_rows), columns=ROW_COLUMNS)
+    # Values that fail to parse drop the whole row.
+    metric_names = list(METRIC_COLUMNS)
+    df[metric_names] = df[metric_names].apply(pd.to_numeric, errors='coerce')
+    df['total_return'] *= 100  # Convert to %
+    # Inferred categories are sorted, so ordering by name compares integer codes.
+    df['Strategy_Name'] = df['Strategy_Name'].astype('category')
+    return df.dropna(subset=metric_names)
+
+@st.cache_data(show_spinner=False, max_entries=VERSION_CACHE_ENTRIES)
+def distinct_types(snapshot_version, _strategies):
+    return sorted(set(s.get("Strategy_Type") for s in _strategies if s.get("Strategy_Type")))
+
+@st.cache_data(show_spinner=False, max_entries=VERSION_CACHE_ENTRIES)
+def strategy_type_options(snapshot_version, _strategies):
+    options = list(dict.fromkeys(QUOTED_BASE + tuple(distinct_types(snapshot_version, _strategies))))
+    return options, {t: i for i, t in enumerate(options)}
+
+@st.cache_data(show_spinner=False, max_entries=METRICS_MD_CACHE_ENTRIES)
+def render_metrics_md(metrics):
+    return '\n'.join(f"- {metric.replace('_', ' ').title()}: {value}" for metric, value in metrics)
+
+def to_row(doc_data):
+    perf = doc_data.get("Performance_Metrics") or {}
+    if isinstance(perf, dict):
+        metrics = (perf.get(field, 0) for field in METRIC_COLUMNS.values())
+    else:
+        # Malformed metrics become NaN so to_frame drops the row, not the batch.
+        metrics = (float('nan') for _ in METRIC_COLUMNS)
+    return (
+        doc_data.get("Strategy_Name") or '',
+        doc_data.get("Strategy_Type") or '',
+        *metrics,
+    )
+
+def to_entry(doc):
+    doc_data = doc.to_dict()
+    if not doc_data:
+        return None
+    doc_data['id'] = doc.id
+    return doc_data, to_row(doc_data)
+
+def decode_change(change):
+    # Runs on the decode pool: build the flat frame row here so reruns never
+    # have to walk the nested documents again.
+    doc = change.document
+    return doc.id, (to_entry(doc) if change.type != ChangeType.REMOVED else None)
+
+def publish_update(item):
+    # Drop the oldest version rather than block the listener thread; readers
+    # rebuild from the store, so a dropped message loses no document state.
+    try:
+        update_queue.put_nowait(item)
+    except queue.Full:
+        try:
+            update_queue.get_nowait()
+        except queue.Empty:
+            pass
+        update_queue.put_nowait(item)
 
 def on_snapshot(col_snapshot, changes, read_time):
-    current_data = []
-    for doc in col_snapshot.documents:
-        doc_data = doc.to_dict()
-        if doc_data:
-            doc_data['id'] = doc.id
-            current_data.append(doc_data)
-    update_queue.put(current_data)
-    st.session_state['data_updated'] = True
+    # Runs on the Firestore watch thread: an exception escaping here stops the
+    # watch for good, so a bad batch is logged and skipped instead.
+    try:
+        decoded = list(decode_executor.map(decode_change, changes))
+        with store_lock:
+            if latest_update.pop('prefetched', False):
+                # The first snapshot is authoritative over the one-shot prefetch and
+                # its changes are all ADDED, so rebuild from it; this also drops
+                # documents deleted in between.
+                strategies_by_id.clear()
+            for doc_id, entry in decoded:
+                if entry:
+                    strategies_by_id[doc_id] = entry
+                else:
+                    strategies_by_id.pop(doc_id, None)
+            # Versioning under the store lock keeps it in step with the store
+            # contents a reader copies while holding the same lock.
+            latest_update['version'] = next(snapshot_versions)
+            publish_update(latest_update['version'])
+            if not ready_event.is_set():
+                ready_event.set()
+    except Exception:
+        logger.exception("Failed to apply a Firestore snapshot; skipping the batch")
+
+def apply_prefetch(future):
+    if future.exception() is not None:
+        logger.warning("Firestore prefetch failed; waiting for the listener", exc_info=future.exception())
+        return
+    entries = [(doc.id, to_entry(doc)) for doc in future.result()]
+    with store_lock:
+        # Whichever of the prefetch and the first snapshot lands first fills the
+        # store; a prefetch arriving after the listener has data is discarded.
+        if ready_event.is_set():
+            return
+        strategies_by_id.update((doc_id, entry) for doc_id, entry in entries if entry)
+        latest_update['prefetched'] = True
+        latest_update['version'] = next(snapshot_versions)
+        publish_update(latest_update['version'])
+        ready_event.set()
+
+def request_rerun_all_sessions():
+    if not st.runtime.exists():
+        return
+    # Streamlit has no public API to rerun other sessions; this relies on the
+    # private Runtime._session_mgr and may break on Streamlit upgrades.
+    for session_info in st.runtime.get_instance()._session_mgr.list_active_sessions():
+        session_info.session.request_rerun(None)
+
+def drain_updates(data_q):
+    # The thread is a cached resource and is never restarted, so a failure must
+    # not end the loop or push updates would stop for the whole process.
+    while True:
+        try:
+            data_q.get()
+            # Coalesce every pending version into one rerun per session.
+            while True:
+                try:
+                    data_q.get_nowait()
+                except queue.Empty:
+                    break
+            request_rerun_all_sessions()
+        except Exception:
+            logger.exception("Failed to push a Firestore update to active sessions")
+
+# One process-wide consumer pushes updates to sessions as they arrive instead of
+# each session polling the queue on its next interaction.
+@st.cache_resource
+def start_update_drainer():
+    drainer = threading.Thread(
+        target=drain_updates,
+        args=(get_update_queue(),),
+        name="firestore-drainer",
+        daemon=True,
+    )
+    drainer.start()
+    return drainer
 
 def setup_firestore_listener(db_client, data_q):
-    collection_path = f"artifacts/infiniquant-da402/public/data/{FIRESTORE_COLLECTION_NAME}"
     try:
-        collection_ref = db_client.collection(collection_path)
+        collection_ref = db_client.collection(FIRESTORE_COLLECTION_PATH)
+        if not ready_event.is_set():
+            # Race a one-shot read against the watch stream's warm-up for the cold start.
+            decode_executor.submit(collection_ref.get).add_done_callback(apply_prefetch)
         collection_watch = collection_ref.on_snapshot(on_snapshot)
-        st.success(f"Listening for updates on collection: {collection_path}")
         return collection_watch
     except Exception as e:
         st.error(f"Error setting up Firestore listener: {e}")
         st.stop()
 
+# One watch per process: the store it feeds is shared by every session, so a
+# watch per browser tab would only multiply reads and reruns.
+# on_release detaches the watch when "Clear cache" drops it, so the next run does
+# not leave the old stream reading every write alongside the new one.
+@st.cache_resource(on_release=lambda watch: watch.unsubscribe())
+def get_collection_watch():
+    watch = setup_firestore_listener(get_firestore_client(), get_update_queue())
+    # on_release is not guaranteed at shutdown; also detach at interpreter exit
+    # so restarts do not leave the streaming RPC behind.
+    atexit.register(watch.unsubscribe)
+    return watch
+
 st.set_page_config(layout="wide", page_title="Quant Strategy Dashboard")
 st.title("\U0001F4C8 Pre-validated Quant Strategies")
 
 db = get_firestore_client()
+# Announced here rather than inside the cached factory, whose elements Streamlit
+# replays on every cache hit.
+if 'firestore_init_announced' not in st.session_state:
+    st.success("Successfully initialized Firestore client.")
+    st.session_state['firestore_init_announced'] = True
 update_queue = get_update_queue()
+strategies_by_id = get_strategies_by_id()
+store_lock = get_store_lock()
+decode_executor = get_decode_executor()
+ready_event = get_ready_event()
+snapshot_versions = get_snapshot_versions()
+latest_update = get_latest_update()
+start_update_drainer()
 
 if 'strategies_data' not in st.session_state:
     st.session_state['strategies_data'] = []
+    st.session_state['strategy_rows'] = []
+    st.session_state['snapshot_version'] = 0
 if 'selected_strategy_type' not in st.session_state:
     st.session_state['selected_strategy_type'] = "All"
-if 'data_updated' not in st.session_state:
-    st.session_state['data_updated'] = False
 
-if 'firestore_listener_started' not in st.session_state:
+get_collection_watch()
+# Like the client, the watch comes from a cached factory, so announce it here.
+if 'firestore_listener_announced' not in st.session_state:
+    st.success(f"Listening for updates on collection: {FIRESTORE_COLLECTION_PATH}")
+    st.session_state['firestore_listener_announced'] = True
+if not ready_event.is_set():
     with st.spinner("Connecting to Firestore and fetching initial data..."):
-        setup_firestore_firestore_listener = setup_firestore_listener(db, update_queue)
-        st.session_state['firestore_listener_started'] = True
-        time.sleep(2)
-
-if not update_queue.empty():
-    with st.spinner("New data arrived! Updating strategies..."):
-        latest_data = update_queue.get()
-        st.session_state['strategies_data'] = latest_data
-        st.session_state['data_updated'] = False
-
-strategy_types_from_data = sorted(list(set(
-    s.get("Strategy_Type") for s in st.session_state['strategies_data'] if s.get("Strategy_Type")
-)))
+        ready_event.wait(timeout=5.0)
 
-base_strategies = ["RSI_ONLY", "MACD_ONLY", "SMA_CROSSOVER", "EMA_CROSSOVER", "BB_BOUNCE",
-                   "RSI_SENTIMENT", "MACD_SENTIMENT", "SMA_SENTIMENT", "ML_PREDICT", 
-                   "FF_INSPIRED_STRATEGY"]
+with store_lock:
+    if st.session_state['snapshot_version'] != latest_update['version']:
+        with st.spinner("New data arrived! Updating strategies..."):
+            entries = list(strategies_by_id.values())
+            st.session_state['strategies_data'] = [doc_data for doc_data, _ in entries]
+            st.session_state['strategy_rows'] = [row for _, row in entries]
+            st.session_state['snapshot_version'] = latest_update['version']
 
-quoted_base_strategies = [f'"{s}"' for s in base_strategies]
-strategy_types_from_data = sorted(list(set(
-    s.get("Strategy_Type") for s in st.session_state['strategies_data'] if s.get("Strategy_Type")
-)))
+def remember_strategy_type():
+    st.session_state['selected_strategy_type'] = st.session_state['strategy_type_selector'].strip('"')
 
-all_strategy_types_set = list(dict.fromkeys(quoted_base_strategies + strategy_types_from_data))
-selected = st.session_state.get('selected_strategy_type')
-quoted_selected = f'"{selected}"' if selected and not selected.startswith('"') else selected
+# Widget interactions only rerun this fragment, not the store refresh above it.
+@st.fragment
+def render_strategies():
+    all_strategy_types_set, types_index = strategy_type_options(
+        st.session_state['snapshot_version'], st.session_state['strategies_data']
+    )
+    selected = st.session_state.get('selected_strategy_type')
+    quoted_selected = f'"{selected}"' if selected and not selected.startswith('"') else selected
 
-if quoted_selected in all_strategy_types_set:
-    all_strategy_types = [quoted_selected] + [s for s in all_strategy_types_set if s != quoted_selected]
-else:
-    all_strategy_types = all_strategy_types_set
+    all_strategy_types = all_strategy_types_set.copy()
+    if quoted_selected in types_index:
+        all_strategy_types.insert(0, all_strategy_types.pop(types_index[quoted_selected]))
 
-selected_type = st.selectbox(
-    "Select Strategy Type:",
-    options=all_strategy_types,
-    key="strategy_type_selector",
-    index=0
-)
+    selected_type = st.selectbox(
+        "Select Strategy Type:",
+        options=all_strategy_types,
+        key="strategy_type_selector",
+        index=0,
+        on_change=remember_strategy_type,
+    )
 
-unquoted_selected_type = selected_type.strip('"')
-if unquoted_selected_type != st.session_state.get('selected_strategy_type'):
-    st.session_state['selected_strategy_type'] = unquoted_selected_type
-    st.rerun()
+    # --- Add filters for key metrics ---
+    st.markdown("### \U0001F4C9 Filter by Performance Metrics")
+    min_sharpe = st.number_input("Minimum Sharpe Ratio", value=0.2)
+    min_profit_factor = st.number_input("Minimum Profit Factor", value=1.0)
+    min_sortino = st.number_input("Minimum Sortino Ratio", value=0.2)
+    min_total_return = st.number_input("Minimum Total Return (%)", value=1.0)
 
-# --- Add filters for key metrics ---
-st.markdown("### \U0001F4C9 Filter by Performance Metrics")
-min_sharpe = st.number_input("Minimum Sharpe Ratio", value=0.2)
-min_profit_factor = st.number_input("Minimum Profit Factor", value=1.0)
-min_sortino = st.number_input("Minimum Sortino Ratio", value=0.2)
-min_total_return = st.number_input("Minimum Total Return (%)", value=1.0)
+    # --- Display Strategies ---
+    st.subheader("Available Strategies")
 
-# --- Display Strategies ---
-st.subheader("Available Strategies")
+    strategies = st.session_state['strategies_data']
+    df = to_frame(st.session_state['snapshot_version'], st.session_state['strategy_rows'])
 
-strategies = st.session_state['strategies_data']
-if selected_type != "All":
-    strategies = [s for s in strategies if s.get("Strategy_Type") == selected_type]
+    mask = (
+        (df.sharpe >= min_sharpe) &
+        (df.pf >= min_profit_factor) &
+        (df.sortino >= min_sortino) &
+        (df.total_return >= min_total_return)
+    )
+    if selected_type != "All":
+        mask &= df.Strategy_Type == selected_type
 
-filtered_strategies = []
-for s in strategies:
-    perf = s.get("Performance_Metrics", {})
-    try:
-        sharpe = float(perf.get("Sharpe_Ratio", 0))
-        pf = float(perf.get("Profit_Factor", 0))
-        sortino = float(perf.get("Sortino_Ratio", 0))
-        total_return = float(perf.get("Total_Return", 0)) * 100  # Convert to %
-    except:
-        continue
-
-    if (
-        sharpe >= min_sharpe and
-        pf >= min_profit_factor and
-        sortino >= min_sortino and
-        total_return >= min_total_return
-    ):
-        filtered_strategies.append(s)
-
-if not filtered_strategies:
-    st.info("No strategies found for the selected filters or type.")
-else:
-    filtered_strategies_sorted = sorted(filtered_strategies, key=lambda x: x.get('Strategy_Name', ''))
-    for strategy in filtered_strategies_sorted:
-        with st.expander(f"**{strategy.get('Strategy_Name', 'N/A')}** - Type: {strategy.get('Strategy_Type', 'N/A')}"):
-            st.write(f"**Description:** {strategy.get('Description', 'N/A')}")
-            st.write(f"**Performance Metrics:**")
+    filtered_strategies = [strategies[i] for i in df.loc[mask].sort_values('Strategy_Name', kind='stable').index]
+
+    if not filtered_strategies:
+        st.info("No strategies found for the selected filters or type.")
+    else:
+        for strategy in filtered_strategies:
             metrics = strategy.get('Performance_Metrics', {})
             if metrics:
-                for metric, value in metrics.items():
-                    st.write(f"- {metric.replace('_', ' ').title()}: {value}")
+                metrics_md = render_metrics_md(tuple(sorted(metrics.items())))
             else:
-                st.write("- No performance metrics available.")
+                metrics_md = "- No performance metrics available."
+            fields = ChainMap(strategy, {'metrics_md': metrics_md}, DISPLAY_DEFAULTS)
+            with st.expander(EXPANDER_TEMPLATE.safe_substitute(fields)):
+                st.markdown(DETAILS_TEMPLATE.safe_substitute(fields))
+                st.caption(CAPTION_TEMPLATE.safe_substitute(fields))
 
-            st.write(f"**Risk Level:** {strategy.get('Risk_Level', 'N/A')}")
-            st.write(f"**Recommended Capital:** {strategy.get('Recommended_Capital', 'N/A')}")
-            st.write(f"**Last Updated:** {strategy.get('Last_Updated', 'N/A')}")
-            st.caption(f"Document ID: {strategy.get('id', 'N/A')}")
+render_strategies()
 
 st.markdown("---")
-st.write("Data last fetched from Firestore. New data will appear automatically (requires user interaction to trigger rerun).")
+st.write("Data last fetched from Firestore. New data will appear automatically.")